@@ -1,202 +1,418 @@
+import os
 import sys
+import stat
+import socket
 import asyncio
 import random
-import json
-import traceback
 import logging
-from collections import defaultdict, deque
-from typing import Any, Callable, Deque, Dict, Optional, Union
+from collections import defaultdict
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional
+
+import orjson
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 logging.basicConfig(level=logging.CRITICAL + 1)
 
 DEFAULT_PORT = 7000
 DEFAULT_CACHE_SIZE = 100
+LISTEN_BACKLOG = 1024
+BUFFER_SIZE = 4 * 1024
+MAX_LINE_LENGTH = 64 * 1024
 
-topics: Dict[str, set] = defaultdict(set)
-topics_reverse: Dict[asyncio.StreamWriter, set] = defaultdict(set)
-caches: Dict[str, deque] = defaultdict(lambda: deque(maxlen=DEFAULT_CACHE_SIZE))
-indexs: Dict[str, int] = defaultdict(int)
 
-template_subscribe: Dict[str, Dict[str, Union[type, bool]]] = {
-    "command": {"type": str, "required": True},
-    "topic": {"type": str, "required": True},
-    "last_seen": {"type": int, "required": False},
-    "cache": {"type": bool, "required": False},
-}
+class CachedCmd(NamedTuple):
+    index: int
+    delivery: str
+    payload: bytes
 
-template_unsubscribe: Dict[str, Dict[str, Union[type, bool]]] = {
-    "command": {"type": str, "required": True},
-    "topic": {"type": str, "required": True},
-}
 
-template_send: Dict[str, Dict[str, Union[type, bool, list]]] = {
-    "command": {"type": str, "required": True},
-    "topic": {"type": str, "required": True},
-    "msg": {"type": str, "required": True},
-    "delivery": {"type": str, "required": True, "values": ["all", "one"]},
-    "cache": {"type": bool, "required": False},
+class RingCache:
+    __slots__ = ("buf", "head", "size", "cap")
+
+    def __init__(self, cap: int) -> None:
+        self.buf: List[Optional[CachedCmd]] = [None] * cap
+        self.head = 0
+        self.size = 0
+        self.cap = cap
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __getitem__(self, i: int) -> CachedCmd:
+        return self.buf[(self.head + i) % self.cap]  # type: ignore[return-value]
+
+    def append(self, entry: CachedCmd) -> None:
+        if self.cap == 0:
+            return
+        if self.size == self.cap:  # full, overwrite the oldest entry
+            self.buf[self.head] = entry
+            self.head = (self.head + 1) % self.cap
+        else:
+            self.buf[(self.head + self.size) % self.cap] = entry
+            self.size += 1
+
+    def bisect(self, index: int) -> int:
+        # indexes only grow, so binary search for the first one past index
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self[mid].index <= index:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def truncate(self, size: int) -> None:
+        for i in range(size, self.size):
+            self.buf[(self.head + i) % self.cap] = None
+        self.size = size
+
+
+class TopicSubs:
+    __slots__ = ("items", "pos")
+
+    def __init__(self) -> None:
+        self.items: List[asyncio.WriteTransport] = []
+        self.pos: Dict[asyncio.WriteTransport, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def __iter__(self) -> Iterator[asyncio.WriteTransport]:
+        return iter(self.items)
+
+    def add(self, writer: asyncio.WriteTransport) -> None:
+        if writer not in self.pos:
+            self.pos[writer] = len(self.items)
+            self.items.append(writer)
+
+    def remove(self, writer: asyncio.WriteTransport) -> None:
+        # swap the last subscriber into the freed slot
+        i = self.pos.pop(writer)
+        last = self.items.pop()
+        if i < len(self.items):
+            self.items[i] = last
+            self.pos[last] = i
+
+    def discard(self, writer: asyncio.WriteTransport) -> None:
+        if writer in self.pos:
+            self.remove(writer)
+
+    def sample_one(self) -> asyncio.WriteTransport:
+        return self.items[random.randrange(len(self.items))]
+
+
+class TopicState:
+    __slots__ = ("subs", "index", "cache")
+
+    def __init__(self) -> None:
+        self.subs = TopicSubs()
+        self.index = 0
+        self.cache = RingCache(cache_size)
+
+
+cache_size = DEFAULT_CACHE_SIZE
+topics: Dict[str, TopicState] = defaultdict(TopicState)
+topics_reverse: Dict[asyncio.WriteTransport, set] = {}
+
+keys_subscribe = frozenset(["command", "topic", "last_seen", "cache"])
+keys_unsubscribe = frozenset(["command", "topic"])
+keys_send = frozenset(["command", "topic", "msg", "delivery", "cache"])
+delivery_values = ("all", "one")
+
+
+def verify_subscribe(cmd: Dict[str, Any]) -> bool:
+    return (
+        cmd.keys() <= keys_subscribe
+        and isinstance(cmd.get("topic"), str)
+        and isinstance(cmd.get("last_seen", -1), int)
+        and isinstance(cmd.get("cache", True), bool)
+    )
+
+
+def verify_unsubscribe(cmd: Dict[str, Any]) -> bool:
+    return cmd.keys() <= keys_unsubscribe and isinstance(cmd.get("topic"), str)
+
+
+def verify_send(cmd: Dict[str, Any]) -> bool:
+    return (
+        cmd.keys() <= keys_send
+        and isinstance(cmd.get("topic"), str)
+        and isinstance(cmd.get("msg"), str)
+        and cmd.get("delivery") in delivery_values
+        and isinstance(cmd.get("cache", True), bool)
+    )
+
+
+verifiers: Dict[str, Callable[[Dict[str, Any]], bool]] = {
+    "subscribe": verify_subscribe,
+    "unsubscribe": verify_unsubscribe,
+    "send": verify_send,
 }
 
 
-def template_match(template: Dict[str, Dict[str, Any]], obj: Dict[str, Any]) -> bool:
-    if not set(obj.keys()).issubset(template.keys()):
-        return False
-    for key, props in template.items():
-        if props["required"] and key not in obj:
-            return False
-        if key in obj and not isinstance(obj[key], props["type"]):
-            return False
-        if "values" in props and obj[key] not in props["values"]:
-            return False
-    return True
+def encode_cmd(cmd: Dict[str, Any]) -> bytes:
+    return orjson.dumps(cmd) + b"\r\n"
 
 
-def send_cmd(writer: asyncio.StreamWriter, cmd: Dict[str, Any]) -> None:
-    writer.write((json.dumps(cmd) + "\r\n").encode("utf8"))
+def send_cmd(writer: asyncio.WriteTransport, cmd: Dict[str, Any]) -> None:
+    writer.write(encode_cmd(cmd))
 
 
-def send_success(writer: asyncio.StreamWriter) -> None:
+def send_success(writer: asyncio.WriteTransport) -> None:
     cmd = {"success": True}
     send_cmd(writer, cmd)
 
 
-def send_failure(writer: asyncio.StreamWriter, reason: str) -> None:
+def send_failure(writer: asyncio.WriteTransport, reason: str) -> None:
     cmd = {"success": False, "reason": reason}
     send_cmd(writer, cmd)
 
 
-def send_cached(writer: asyncio.StreamWriter, topic: str, last_seen: int) -> None:
-    for cmd in caches[topic]:
-        if cmd["index"] > last_seen:
-            send_cmd(writer, cmd)
-    new_cache: Deque[Dict[str, Any]] = deque(maxlen=cache_size)
-    for cmd in caches[topic]:
-        if cmd["index"] <= last_seen:
-            new_cache.append(cmd)
-        else:
-            if cmd["delivery"] == "all":
-                new_cache.append(cmd)
-    caches[topic] = new_cache
-
-
-def handle_subscribe(cmd: Dict[str, Any], writer: asyncio.StreamWriter) -> None:
-    topics[cmd["topic"]].add(writer)
-    topics_reverse[writer].add(cmd["topic"])
+def send_cached(
+    writer: asyncio.WriteTransport, state: TopicState, last_seen: int
+) -> None:
+    cache = state.cache
+    start = cache.bisect(last_seen)
+    replay = [cache[i] for i in range(start, len(cache))]
+    if not replay:
+        return
+    writer.write(b"".join(entry.payload for entry in replay))
+    if any(entry.delivery != "all" for entry in replay):
+        # delivery == 'one' is consumed by this subscriber
+        cache.truncate(start)
+        for entry in replay:
+            if entry.delivery == "all":
+                cache.append(entry)
+
+
+def release_topic(topic: str, state: TopicState) -> None:
+    # once published to, a topic keeps its index and cache for late subscribers
+    if not state.subs and state.index == 0:
+        del topics[topic]
+
+
+def handle_subscribe(cmd: Dict[str, Any], writer: asyncio.WriteTransport) -> None:
+    topic = sys.intern(cmd["topic"])
+    state = topics[topic]
+    state.subs.add(writer)
+    topics_reverse.setdefault(writer, set()).add(topic)
     last_seen = int(cmd["last_seen"]) if "last_seen" in cmd else -1
     send_success(writer)
     if cmd.get("cache", True):
-        send_cached(writer, cmd["topic"], last_seen)
+        send_cached(writer, state, last_seen)
 
 
-def handle_unsubscribe(cmd: Dict[str, Any], writer: asyncio.StreamWriter) -> None:
-    topics[cmd["topic"]].remove(writer)
-    topics_reverse[writer].remove(cmd["topic"])
+def handle_unsubscribe(cmd: Dict[str, Any], writer: asyncio.WriteTransport) -> None:
+    topic = sys.intern(cmd["topic"])
+    topics_reverse[writer].remove(topic)
+    state = topics[topic]
+    state.subs.remove(writer)
+    release_topic(topic, state)
     send_success(writer)
 
 
-def handle_send(cmd: Dict[str, Any], writer: asyncio.StreamWriter) -> None:
-    cmd["index"] = indexs[cmd["topic"]]
-    indexs[cmd["topic"]] += 1
+def handle_send(cmd: Dict[str, Any], writer: asyncio.WriteTransport) -> None:
+    state = topics[sys.intern(cmd["topic"])]
+    subs = state.subs
+    index = state.index
+    state.index += 1
+    cmd["index"] = index
     do_cache = cmd.get("cache", True)
     if cmd["delivery"] == "all":
-        subscribers = topics[cmd["topic"]]
+        subscribers = subs
     else:  # delivery == 'one':
-        if len(topics[cmd["topic"]]) == 0:
-            subscribers = set([])
+        if len(subs) == 0:
+            subscribers = ()
         else:
-            which = random.randint(0, len(topics[cmd["topic"]]) - 1)
-            subscribers = set([list(topics[cmd["topic"]])[which]])
+            subscribers = (subs.sample_one(),)
             do_cache = False
+    # serialize once, every subscriber and later cache replays get the same bytes
+    payload = encode_cmd(cmd)
     if do_cache:
-        caches[cmd["topic"]].append(cmd)
+        state.cache.append(CachedCmd(index, cmd["delivery"], payload))
     for subscriber in subscribers:
-        send_cmd(subscriber, cmd)
+        subscriber.write(payload)
     send_success(writer)
 
 
 def verify_command(cmd: Dict[str, Any]) -> bool:
-    templates: Dict[str, Dict[str, Dict[str, Any]]] = {
-        "subscribe": template_subscribe,
-        "unsubscribe": template_unsubscribe,
-        "send": template_send,
-    }
     if "command" not in cmd or not isinstance(cmd["command"], str):
         return False
-    template: Optional[Dict[str, Dict[str, Any]]] = templates.get(cmd["command"])
-    if template is None or not template_match(template, cmd):
-        return False
-    return True
+    verifier = verifiers.get(cmd["command"])
+    return verifier is not None and verifier(cmd)
 
 
-def handle_command(cmd: Dict[str, Any], writer: asyncio.StreamWriter) -> None:
-    handlers = {
-        "subscribe": handle_subscribe,
-        "unsubscribe": handle_unsubscribe,
-        "send": handle_send,
-    }
+handlers: Dict[str, Callable[[Dict[str, Any], asyncio.WriteTransport], None]] = {
+    "subscribe": handle_subscribe,
+    "unsubscribe": handle_unsubscribe,
+    "send": handle_send,
+}
+
+
+def handle_command(cmd: Dict[str, Any], writer: asyncio.WriteTransport) -> None:
     handler = handlers.get(cmd["command"])
     if handler:
         handler(cmd, writer)
 
 
-async def handle_client(
-    reader: asyncio.StreamReader, writer: asyncio.StreamWriter
-) -> None:
-    logging.info("New client connected...")
-    line = str()
+def parse_failure_reason(line: bytes) -> str:
+    # orjson validates UTF-8 itself, only decode to tell the two failures apart
+    try:
+        line.decode("utf8")
+    except UnicodeDecodeError:
+        return "Could not decode input as UTF-8"
+    return "Could not parse json"
+
+
+def handle_line(line: bytes, writer: asyncio.WriteTransport) -> None:
+    logging.info("Received: %r", line)
     try:
-        while line.strip() != "quit":
-            line = await reader.readline()
-            if not line:  # Check for EOF
-                logging.info("Client disconnected (EOF)")
-                break
-            try:
-                line = line.decode("utf8").strip()
-            except UnicodeDecodeError:
-                send_failure(writer, "Could not decode input as UTF-8")
-                continue
-            if line == "":
-                continue
-            logging.info(f"Received: {line}")
-            try:
-                cmd = json.loads(line)
-            except json.JSONDecodeError:
-                send_failure(writer, "Could not parse json")
+        cmd = orjson.loads(line)
+    except orjson.JSONDecodeError:
+        send_failure(writer, parse_failure_reason(line))
+    else:
+        try:
+            if verify_command(cmd):
+                handle_command(cmd, writer)
             else:
-                try:
-                    if verify_command(cmd):
-                        handle_command(cmd, writer)
-                    else:
-                        send_failure(writer, "Malformed json message")
-                except Exception as e:
-                    logging.info(traceback.format_exc())
-                    send_failure(writer, "Internal exception")
-    except Exception as e:
-        logging.info(traceback.format_exc())
-    finally:
-        if writer in topics_reverse:
-            for topic in topics_reverse[writer]:
-                topics[topic].remove(writer)
-            del topics_reverse[writer]
-        writer.close()
-        await writer.wait_closed()
+                send_failure(writer, "Malformed json message")
+        except Exception as e:
+            logging.info("Command failed", exc_info=True)
+            send_failure(writer, "Internal exception")
+
+
+class MemqProtocol(asyncio.BufferedProtocol):
+    __slots__ = ("buffer", "used", "transport")
+
+    def __init__(self) -> None:
+        self.buffer = bytearray(BUFFER_SIZE)
+        self.used = 0
+        self.transport: asyncio.Transport
+
+    def connection_made(self, transport: asyncio.Transport) -> None:  # type: ignore[override]
+        logging.info("New client connected...")
+        self.transport = transport
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        if self.used == len(self.buffer):
+            self.buffer.extend(bytes(len(self.buffer)))
+        return memoryview(self.buffer)[self.used :]
+
+    def buffer_updated(self, nbytes: int) -> None:
+        # the transport writes straight into self.buffer, dispatch every
+        # complete line and move the unterminated tail to the front
+        buffer, transport = self.buffer, self.transport
+        start, self.used = 0, self.used + nbytes
+        end = buffer.find(b"\n", self.used - nbytes, self.used)
+        while end != -1:
+            line = buffer[start:end].strip()
+            start = end + 1
+            if line:
+                handle_line(line, transport)
+            if line == b"quit":
+                transport.close()
+                return
+            end = buffer.find(b"\n", start, self.used)
+        if start:
+            # same-size slice assignment, the buffer is exported to the transport
+            remaining = self.used - start
+            buffer[:remaining] = buffer[start : self.used]
+            self.used = remaining
+        if self.used > MAX_LINE_LENGTH:
+            logging.info("Line too long, disconnecting")
+            transport.close()
+
+    def eof_received(self) -> Optional[bool]:
+        line = self.buffer[: self.used].strip()
+        if line:
+            handle_line(line, self.transport)
+        logging.info("Client disconnected (EOF)")
+        return None
+
+    def pause_writing(self) -> None:
+        # the client is not reading its replies, stop reading its commands
+        self.transport.pause_reading()
+
+    def resume_writing(self) -> None:
+        self.transport.resume_reading()
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        for topic in topics_reverse.pop(self.transport, ()):
+            state = topics[topic]
+            state.subs.discard(self.transport)
+            release_topic(topic, state)
         logging.info("Client disconnected...")
 
 
 async def run_server(host: str, port: int) -> None:
-    server = await asyncio.start_server(handle_client, host, port)
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(
+        MemqProtocol, host, port, backlog=LISTEN_BACKLOG
+    )
     logging.info(f"Listening on {host}:{port}...")
     async with server:
         await server.serve_forever()
 
 
+def remove_stale_socket(path: str) -> None:
+    # a socket file left behind by a previous run would make the bind fail,
+    # but one somebody still listens on is left alone so the bind fails loudly
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            return
+    except FileNotFoundError:
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(path)
+        except ConnectionRefusedError:
+            os.unlink(path)
+
+
+def bind_unix_socket(path: str) -> socket.socket:
+    # bind here instead of passing the path to create_unix_server, which would
+    # unlink any socket already at the path, live or not
+    remove_stale_socket(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.bind(path)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+async def run_unix_server(path: str) -> None:
+    loop = asyncio.get_running_loop()
+    server = await loop.create_unix_server(
+        MemqProtocol, sock=bind_unix_socket(path), backlog=LISTEN_BACKLOG
+    )
+    logging.info(f"Listening on {path}...")
+    async with server:
+        await server.serve_forever()
+
+
 if __name__ == "__main__":
-    if len(sys.argv) not in [1, 2, 3]:
-        logging.info(f"Usage: python3 aiomemq.py <port> <cache_size>")
+    args = sys.argv[1:]
+    unix_socket = None
+    if args[:1] == ["--unix-socket"] and len(args) >= 2:
+        unix_socket, args = args[1], args[2:]
+    if len(args) > 2 or "--unix-socket" in args:
+        logging.info(f"Usage: python3 aiomemq.py [--unix-socket <path>] <port> <cache_size>")
+        logging.info(f"  <path>       - optional, listen on this unix socket instead of TCP")
         logging.info(f"  <port>       - optional, default {DEFAULT_PORT}")
         logging.info(f"  <cache_size> - optional, default {DEFAULT_CACHE_SIZE}")
         sys.exit(1)
-    port = int(sys.argv[1]) if len(sys.argv) <= 3 else DEFAULT_PORT
-    cache_size = int(sys.argv[2]) if len(sys.argv) == 3 else DEFAULT_CACHE_SIZE
-    caches = defaultdict(lambda: deque(maxlen=cache_size))
-    asyncio.run(run_server(host="localhost", port=port))
+    port = int(args[0]) if len(args) >= 1 else DEFAULT_PORT
+    cache_size = int(args[1]) if len(args) == 2 else DEFAULT_CACHE_SIZE
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    if unix_socket is not None:
+        asyncio.run(run_unix_server(unix_socket))
+    else:
+        asyncio.run(run_server(host="localhost", port=port))
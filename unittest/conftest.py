@@ -2,3 +2,5 @@ import pytest
 
 def pytest_addoption(parser):
     parser.addoption("--target", action="store", default="python")
+    parser.addoption("--unix-socket", action="store_true", default=False,
+                     help="run the python target on a unix socket instead of TCP")
@@ -1,5 +1,10 @@
-from collections import defaultdict
+from collections import deque
+from contextlib import contextmanager
+import array
 import subprocess
+import tempfile
+import asyncio
+import queue
 import warnings
 import socket
 import random
@@ -8,62 +13,191 @@ import pytest
 import time
 import json
 import os
+import selectors
+import threading
+import weakref
+
+try:
+    from orjson import dumps, loads, OPT_SORT_KEYS
+    def canonical(obj):
+        return dumps(obj, option=OPT_SORT_KEYS)
+except ImportError:
+    def dumps(obj):
+        return json.dumps(obj).encode('utf-8')
+    def canonical(obj):
+        return json.dumps(obj, sort_keys=True).encode('utf-8')
+    loads = json.loads
 
 SERVER_HOST = 'localhost'
-SERVER_PORT = 7000
+# under pytest-xdist every worker starts its own server, on its own port
+SERVER_PORT = 7000 + int(os.environ.get('PYTEST_XDIST_WORKER', 'gw0')[len('gw'):])
 CACHE_SIZE = 2
+RECEIVE_TIMEOUT = 1.0
+UNIX_CONNECT_CONCURRENCY = 512  # below the python server's LISTEN_BACKLOG of 1024
+MALFORMED = {'success': False, 'reason': 'Malformed json message'}
 
 # pytest-3 -v unittests.py --target=python --full-trace -x
 # pytest-3 -v unittests.py --target=javascript --full-trace -x
+# pytest-3 -v unittests.py --target=python -n auto   (with pytest-xdist)
+# pytest-3 -v unittests.py --target=python --unix-socket   (no TCP handshakes, no ephemeral ports to run out of)
 
-@pytest.fixture(scope="module")
+def wait_for_server(server_process, timeout=5.0):
+    # poll until the server accepts connections instead of sleeping a fixed time
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            connect(timeout=0.05).close()
+            return
+        except OSError:
+            if server_process.poll() is not None or time.monotonic() > deadline:
+                raise
+            time.sleep(0.01)
+
+@pytest.fixture(scope="session")
 def server(pytestconfig):
+    global server_unix_socket
     # Start the server as a separate process
     target = pytestconfig.getoption("target")
     # warnings.warn(UserWarning(f"Using target={target}"))
-    if target == 'python':
+    if target == 'python' and pytestconfig.getoption("unix_socket"):
+        # a private directory per session, so concurrent sessions never share a socket path
+        server_unix_socket = os.path.join(tempfile.mkdtemp(prefix='aiomemq-'), 'aiomemq.sock')
+        server_process = subprocess.Popen(['python3', '../python/aiomemq.py', '--unix-socket', server_unix_socket, str(SERVER_PORT), str(CACHE_SIZE)])
+    elif target == 'python':
         server_process = subprocess.Popen(['python3', '../python/aiomemq.py', str(SERVER_PORT), str(CACHE_SIZE)])
     elif target == 'javascript':
         server_process = subprocess.Popen(['node', '../javascript/aiomemq.js', str(SERVER_PORT), str(CACHE_SIZE)])
-    time.sleep(1)  # Give the server some time to start
+    wait_for_server(server_process)
     yield
+    while not connection_pool.empty():
+        connection_pool.get_nowait().close()
     server_process.terminate()
     server_process.wait()
+    if server_unix_socket is not None:
+        try:
+            os.unlink(server_unix_socket)
+        except FileNotFoundError:
+            pass
+        os.rmdir(os.path.dirname(server_unix_socket))
+        server_unix_socket = None
+
+# set by the server fixture when the target listens on a unix socket, None means TCP
+server_unix_socket = None
+
+def connect(timeout=None):
+    if server_unix_socket is not None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(server_unix_socket)
+        except BaseException:
+            sock.close()
+            raise
+    else:
+        sock = socket.create_connection((SERVER_HOST, SERVER_PORT), timeout=timeout)
+        # the tests write small messages and wait for the reply, don't let Nagle hold them back
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.settimeout(None)
+    return sock
 
-def receive(sock):
-    response = sock.recv(64*1024).decode('utf-8').strip()
-    return json.loads(response)
+# idle connections for tests that leave no server-side state behind (no subscriptions)
+connection_pool = queue.LifoQueue()
 
-def receive_many(sock, timeout=None, allow_trailing_bytes=False):
-    sock.settimeout(timeout)
-    response = ''
+@contextmanager
+def pooled_connection():
     try:
-        response = sock.recv(64*1024).decode('utf-8').strip()
-    except TimeoutError:
+        client = connection_pool.get_nowait()
+    except queue.Empty:
+        client = connect()
+    try:
+        yield client
+    except BaseException:
+        client.close()
+        raise
+    # drop anything left unread so the next test starts clean
+    residuals.pop(client, None)
+    client.setblocking(False)
+    try:
+        while True:
+            if not client.recv(64*1024):  # the server closed the connection
+                client.close()
+                return
+    except BlockingIOError:
         pass
-    sock.settimeout(None)
-    messages = response.split("\r\n")
-    response = []
-    if allow_trailing_bytes:
-        for msg in messages:
-            try:
-                response.append(json.loads(msg))
-            except:
-                return response
-    else:
-        response = [json.loads(msg) for msg in messages if msg]
-    return response
+    client.setblocking(True)
+    connection_pool.put_nowait(client)
 
-def receive_until(sock, expected_count, timeout=0.05, allow_trailing_bytes=False):
-    responses = []
-    while len(responses) < expected_count:
-        try:
-            r = receive_many(sock, timeout, allow_trailing_bytes)
-            if len(r) == 0:
-                break
-            responses.extend(r)
-        except socket.timeout:
-            break
+# reusable receive buffers, so every recv doesn't allocate a fresh 64k bytes
+recv_buffers = deque()
+# bytes received but not yet consumed, per socket, a reply can straddle two reads
+residuals = weakref.WeakKeyDictionary()
+
+def recv_into_residual(sock, residual):
+    buf = recv_buffers.pop() if recv_buffers else bytearray(64*1024)
+    try:
+        n = sock.recv_into(buf)
+        residual += memoryview(buf)[:n]
+        return n
+    finally:
+        recv_buffers.append(buf)
+
+def take_frames(residual, limit=None):
+    frames = []
+    start = 0
+    end = residual.find(b"\r\n")
+    while end != -1 and (limit is None or len(frames) < limit):
+        if end > start:
+            frames.append(bytes(residual[start:end]))
+        start = end + 2
+        end = residual.find(b"\r\n", start)
+    del residual[:start]
+    return frames
+
+def read_frames(sock, timeout, limit=None):
+    residual = residuals.setdefault(sock, bytearray())
+    frames = take_frames(residual, limit)
+    sock.settimeout(timeout)
+    try:
+        while not frames:
+            if not recv_into_residual(sock, residual):
+                break  # the server closed the connection
+            frames = take_frames(residual, limit)
+    finally:
+        sock.settimeout(None)
+    return frames
+
+def receive(sock, timeout=RECEIVE_TIMEOUT):
+    return loads(read_frames(sock, timeout, limit=1)[0])
+
+def parse_frames(messages):
+    # take_frames keeps partial trailing frames for the next read, so every frame here is complete
+    return [loads(msg) for msg in messages]
+
+def receive_many(sock, timeout=None):
+    try:
+        messages = read_frames(sock, timeout)
+    except TimeoutError:
+        return []
+    return parse_frames(messages)
+
+# one selector per thread, receive_until registers its socket for the duration of the call
+selectors_local = threading.local()
+
+def receive_until(sock, expected_count, timeout=0.05):
+    if not hasattr(selectors_local, 'selector'):
+        selectors_local.selector = selectors.DefaultSelector()
+    selector = selectors_local.selector
+    residual = residuals.setdefault(sock, bytearray())
+    responses = parse_frames(take_frames(residual))
+    selector.register(sock, selectors.EVENT_READ)
+    try:
+        # stop once enough replies arrived, or nothing arrived for timeout seconds
+        while len(responses) < expected_count and selector.select(timeout):
+            if not recv_into_residual(sock, residual):
+                break  # the server closed the connection
+            responses.extend(parse_frames(take_frames(residual)))
+    finally:
+        selector.unregister(sock)
     return responses
 
 
@@ -73,43 +207,67 @@ def send(sock, message):
     elif isinstance(message, bytes):
         sock.sendall(message + b"\r\n")
     else:
-        sock.sendall((json.dumps(message) + "\r\n").encode('utf-8'))
+        sock.sendall(dumps(message) + b"\r\n")
 
 def send_and_receive(sock, message):
     send(sock, message)
-    time.sleep(0.01)
     return receive(sock)
 
-def send_and_receive_many(sock, message, allow_trailing_bytes=False):
+def send_and_receive_many(sock, message):
     send(sock, message)
-    time.sleep(0.01)
-    return receive_many(sock, timeout=None, allow_trailing_bytes=allow_trailing_bytes)
+    response = receive_many(sock, timeout=RECEIVE_TIMEOUT)
+    # the first read returns as soon as any reply arrives, collect the rest until the server goes quiet
+    response.extend(receive_until(sock, float('inf'), timeout=0.01))
+    return response
 
-def send_and_receive_until(sock, message, expected_count, timeout=0.05, allow_trailing_bytes=False):
+def send_and_receive_until(sock, message, expected_count, timeout=0.05):
     send(sock, message)
-    time.sleep(0.01)
-    return receive_until(sock, expected_count, timeout, allow_trailing_bytes)
+    return receive_until(sock, expected_count, timeout)
+
+def alphabet_translation(alphabet):
+    # maps random bytes onto the alphabet, bytes past the last whole multiple
+    # of len(alphabet) are deleted so every character stays equally likely
+    usable = 256 - 256 % len(alphabet)
+    table = bytes(alphabet[i % len(alphabet)] for i in range(usable)) + bytes(256 - usable)
+    return table, bytes(range(usable, 256))
+
+TOPIC_TRANSLATION = alphabet_translation((string.ascii_lowercase + string.digits).encode())
+STRING_TRANSLATION = alphabet_translation((string.ascii_letters + string.digits).encode())
+
+def generate_random_chars(translation, length):
+    table, delete = translation
+    chars = b''
+    while len(chars) < length:
+        chars += os.urandom(length - len(chars) + 8).translate(table, delete)
+    return chars[:length].decode('ascii')
+
+TOPIC_LENGTH = 8
 
 def generate_random_topic():
-    return ''.join(random.choices(string.ascii_lowercase + string.digits, k=8))
+    return generate_random_chars(TOPIC_TRANSLATION, TOPIC_LENGTH)
+
+def generate_random_topics(count):
+    # one urandom draw and translate for the whole batch, then cut it into topics
+    chars = generate_random_chars(TOPIC_TRANSLATION, TOPIC_LENGTH * count)
+    return [chars[i:i + TOPIC_LENGTH] for i in range(0, len(chars), TOPIC_LENGTH)]
 
 def generate_random_string(length):
-    return ''.join(random.choices(string.ascii_letters + string.digits, k=length))
+    return generate_random_chars(STRING_TRANSLATION, length)
 
 def generate_random_bytes(length):
     return os.urandom(length)
 
 def _test_random_bytes(length):
     random_bytes = generate_random_bytes(length)
-    with socket.create_connection((SERVER_HOST, SERVER_PORT)) as client:
-        response = send_and_receive_many(client, random_bytes, allow_trailing_bytes=True)
+    with connect() as client:
+        response = send_and_receive_many(client, random_bytes)
         # the random bytes could generate multiple responses
         for r in response: r == {'success': False, 'reason': 'Could not decode input as UTF-8'}
 
 def _test_random_string(length):
     random_bytes = generate_random_string(length)
-    with socket.create_connection((SERVER_HOST, SERVER_PORT)) as client:
-        response = send_and_receive_many(client, random_bytes, allow_trailing_bytes=True)
+    with connect() as client:
+        response = send_and_receive_many(client, random_bytes)
         # the random bytes could generate multiple responses
         for r in response: r == {'success': False, 'reason': 'Could not parse json'}
 
@@ -139,84 +297,67 @@ def test_random_string_10k(server):
 def test_random_string_64k(server):
     return _test_random_string(64*1024-2)
 
+# every probe below is rejected before its topic is looked at, so one fixed topic does,
+# and each probe is encoded once at import instead of on every send
+PROBE_TOPIC = 'validation'
+
+def encode_probes(*probes):
+    return [dumps(probe) + b"\r\n" for probe in probes]
+
+SUBSCRIBE_PROBES = encode_probes(
+    {'command': 'subscribe'},                                                          # missing key
+    {'command': 'subscribe', 'topic': PROBE_TOPIC, 'extra_key': 'extra_value'},        # extra key
+    {'command': 123, 'topic': PROBE_TOPIC},                                            # bad type
+    {'command': 'subscribe', 'topic': 123},                                            # bad type
+    {'command': 'subscribe', 'topic': PROBE_TOPIC, 'last_seen': "123"},                # bad type
+    {'command': 'subscribe', 'topic': PROBE_TOPIC, 'cache': 123},                      # bad type
+)
+
+UNSUBSCRIBE_PROBES = encode_probes(
+    {'command': 'unsubscribe'},                                                        # missing key
+    {'command': 'unsubscribe', 'topic': PROBE_TOPIC, 'extra_key': 'extra_value'},      # extra key
+    {'command': 123, 'topic': PROBE_TOPIC},                                            # bad type
+    {'command': 'unsubscribe', 'topic': 123},                                          # bad type
+)
+
+SEND_PROBES = encode_probes(
+    {'topic': PROBE_TOPIC, 'msg': 'hello', 'delivery': 'all'},                         # missing key (command)
+    {'command': 'send', 'msg': 'hello', 'delivery': 'all'},                            # missing key (topic)
+    {'command': 'send', 'topic': PROBE_TOPIC, 'delivery': 'all'},                      # missing key (msg)
+    {'command': 'send', 'topic': PROBE_TOPIC, 'msg': 'hello'},                         # missing key (delivery)
+    {'command': 'send', 'topic': PROBE_TOPIC, 'msg': 'hello', 'delivery': 'all', 'extra_key': 'extra_value'},  # extra key
+    {'command': 123, 'topic': PROBE_TOPIC, 'msg': 'hello', 'delivery': 'all'},         # bad type (command)
+    {'command': 'send', 'topic': 123, 'msg': 'hello', 'delivery': 'all'},              # bad type (topic)
+    {'command': 'send', 'topic': PROBE_TOPIC, 'msg': 123, 'delivery': 'all'},          # bad type (msg)
+    {'command': 'send', 'topic': PROBE_TOPIC, 'msg': 'hello', 'delivery': 123},        # bad type (delivery)
+    {'command': 'send', 'topic': PROBE_TOPIC, 'msg': 'hello', 'delivery': 'invalid'},  # invalid value (delivery)
+    {'command': 'send', 'topic': PROBE_TOPIC, 'msg': 'hello', 'delivery': 'all', 'cache': 'not_a_bool'},  # bad type (cache)
+)
+
+NON_EXISTING_COMMAND_PROBES = encode_probes(
+    {'command': 'non_existing_command', 'topic': PROBE_TOPIC},
+    {'command': 'invalid_command', 'topic': PROBE_TOPIC},
+    {'command': 'fake_command', 'topic': PROBE_TOPIC},
+)
+
+def _test_probes(probes):
+    with pooled_connection() as client1:
+        for probe in probes:
+            client1.sendall(probe)
+            assert receive(client1) == MALFORMED, probe
+
 def test_subscribe_validation(server):
-    topic = generate_random_topic()
-    with socket.create_connection((SERVER_HOST, SERVER_PORT)) as client1:
-        # missing key
-        response = send_and_receive(client1, {'command': 'subscribe'})
-        assert response == {'success': False, 'reason': 'Malformed json message'}
-        # extra key
-        response = send_and_receive(client1, {'command': 'subscribe', 'topic': topic, 'extra_key': 'extra_value'})
-        assert response == {'success': False, 'reason': 'Malformed json message'}
-        # bad type
-        response = send_and_receive(client1, {'command': 123, 'topic': topic})
-        assert response == {'success': False, 'reason': 'Malformed json message'}
-        # bad type
-        response = send_and_receive(client1, {'command': 'subscribe', 'topic': 123})
-        assert response == {'success': False, 'reason': 'Malformed json message'}
-        # bad type
-        response = send_and_receive(client1, {'command': 'subscribe', 'topic': topic, 'last_seen': "123"})
-        assert response == {'success': False, 'reason': 'Malformed json message'}
-        # bad type
-        response = send_and_receive(client1, {'command': 'subscribe', 'topic': topic, 'cache': 123})
-        assert response == {'success': False, 'reason': 'Malformed json message'}
+    _test_probes(SUBSCRIBE_PROBES)
 
 def test_unsubscribe_validation(server):
-    topic = generate_random_topic()
-    with socket.create_connection((SERVER_HOST, SERVER_PORT)) as client1:
-        # missing key
-        response = send_and_receive(client1, {'command': 'unsubscribe'})
-        assert response == {'success': False, 'reason': 'Malformed json message'}
-        # extra key
-        response = send_and_receive(client1, {'command': 'unsubscribe', 'topic': topic, 'extra_key': 'extra_value'})
-        assert response == {'success': False, 'reason': 'Malformed json message'}
-        # bad type
-        response = send_and_receive(client1, {'command': 123, 'topic': topic})
-        assert response == {'success': False, 'reason': 'Malformed json message'}
-        # bad type
-        response = send_and_receive(client1, {'command': 'unsubscribe', 'topic': 123})
-        assert response == {'success': False, 'reason': 'Malformed json message'}
+    _test_probes(UNSUBSCRIBE_PROBES)
 
 def test_send_validation(server):
-    topic = generate_random_topic()
-    with socket.create_connection((SERVER_HOST, SERVER_PORT)) as client1:
-        # missing key (command)
-        response = send_and_receive(client1, {'topic': topic, 'msg': 'hello', 'delivery': 'all'})
-        assert response == {'success': False, 'reason': 'Malformed json message'}
-        # missing key (topic)
-        response = send_and_receive(client1, {'command': 'send', 'msg': 'hello', 'delivery': 'all'})
-        assert response == {'success': False, 'reason': 'Malformed json message'}
-        # missing key (msg)
-        response = send_and_receive(client1, {'command': 'send', 'topic': topic, 'delivery': 'all'})
-        assert response == {'success': False, 'reason': 'Malformed json message'}
-        # missing key (delivery)
-        response = send_and_receive(client1, {'command': 'send', 'topic': topic, 'msg': 'hello'})
-        assert response == {'success': False, 'reason': 'Malformed json message'}
-        # extra key
-        response = send_and_receive(client1, {'command': 'send', 'topic': topic, 'msg': 'hello', 'delivery': 'all', 'extra_key': 'extra_value'})
-        assert response == {'success': False, 'reason': 'Malformed json message'}
-        # bad type (command)
-        response = send_and_receive(client1, {'command': 123, 'topic': topic, 'msg': 'hello', 'delivery': 'all'})
-        assert response == {'success': False, 'reason': 'Malformed json message'}
-        # bad type (topic)
-        response = send_and_receive(client1, {'command': 'send', 'topic': 123, 'msg': 'hello', 'delivery': 'all'})
-        assert response == {'success': False, 'reason': 'Malformed json message'}
-        # bad type (msg)
-        response = send_and_receive(client1, {'command': 'send', 'topic': topic, 'msg': 123, 'delivery': 'all'})
-        assert response == {'success': False, 'reason': 'Malformed json message'}
-        # bad type (delivery)
-        response = send_and_receive(client1, {'command': 'send', 'topic': topic, 'msg': 'hello', 'delivery': 123})
-        assert response == {'success': False, 'reason': 'Malformed json message'}
-        # invalid value (delivery)
-        response = send_and_receive(client1, {'command': 'send', 'topic': topic, 'msg': 'hello', 'delivery': 'invalid'})
-        assert response == {'success': False, 'reason': 'Malformed json message'}
-        # bad type (cache)
-        response = send_and_receive(client1, {'command': 'send', 'topic': topic, 'msg': 'hello', 'delivery': 'all', 'cache': 'not_a_bool'})
-        assert response == {'success': False, 'reason': 'Malformed json message'}
+    _test_probes(SEND_PROBES)
 
 def test_quoting(server):
     strings_with_quotes = ["''''''", '""""""', "'\"'\"'\""]
-    with socket.create_connection((SERVER_HOST, SERVER_PORT)) as client1:
+    with connect() as client1:
         for s in strings_with_quotes:
             # Subscribe to the topic with quotes
             response = send_and_receive(client1, {'command': 'subscribe', 'topic': s})
@@ -235,7 +376,7 @@ def test_quoting(server):
 
 def _test_topic_length(length):
     topic = "a" * length
-    with socket.create_connection((SERVER_HOST, SERVER_PORT)) as client1:
+    with connect() as client1:
         # Subscribe to the topic
         response = send_and_receive(client1, {'command': 'subscribe', 'topic': topic})
         assert response == {'success': True}
@@ -265,13 +406,13 @@ def _test_concurrent_clients(delivery):
     clients = []
     # Create multiple clients
     for i in range(3):
-        client = socket.create_connection((SERVER_HOST, SERVER_PORT))
+        client = connect()
         clients.append(client)
         # Subscribe each client to the topic
         response = send_and_receive(client, {'command': 'subscribe', 'topic': topic})
         assert response == {'success': True}
     # Send a message to the topic
-    sender = socket.create_connection((SERVER_HOST, SERVER_PORT))
+    sender = connect()
     message = {'command': 'send', 'topic': topic, 'msg': 'test message', 'delivery': delivery}
     response = send_and_receive(sender, message)
     assert response == {'success': True}
@@ -315,49 +456,91 @@ def test_concurrent_clients_one(server):
     _test_concurrent_clients('one')
 
 def test_non_existing_commands(server):
-    topic = generate_random_topic()
-    with socket.create_connection((SERVER_HOST, SERVER_PORT)) as client1:
-        # Non-existing command
-        response = send_and_receive(client1, {'command': 'non_existing_command', 'topic': topic})
-        assert response == {'success': False, 'reason': 'Malformed json message'}
-        # Another non-existing command
-        response = send_and_receive(client1, {'command': 'invalid_command', 'topic': topic})
-        assert response == {'success': False, 'reason': 'Malformed json message'}
-        # Yet another non-existing command
-        response = send_and_receive(client1, {'command': 'fake_command', 'topic': topic})
-        assert response == {'success': False, 'reason': 'Malformed json message'}
-
-def _test_many_connections(server, num_clients, num_messages):
-    clients = []
-    topics = []
-    expected_counts = defaultdict(int)
+    _test_probes(NON_EXISTING_COMMAND_PROBES)
+
+class ManyConnectionsClient(asyncio.Protocol):
+    # collects replies as they arrive, done resolves once expected_count of them are in
+    def __init__(self):
+        self.residual = bytearray()
+        self.expect(1)  # the subscribe reply
+
+    def expect(self, expected_count):
+        self.received_messages = []
+        self.expected_count = expected_count
+        self.done = asyncio.get_running_loop().create_future()
+        if expected_count == 0:
+            self.done.set_result(None)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.residual += data
+        self.received_messages.extend(parse_frames(take_frames(self.residual)))
+        if len(self.received_messages) >= self.expected_count and not self.done.done():
+            self.done.set_result(None)
+
+    def connection_lost(self, exc):
+        if not self.done.done():
+            self.done.set_result(None)
+
+async def _async_many_connections(num_clients, num_messages):
+    loop = asyncio.get_running_loop()
+    topics = generate_random_topics(num_clients)
+    # client ids are dense, a flat array counts without hashing
+    expected_counts = array.array('i', [0] * num_clients)
     # Step 1: All clients connect and create a topic for themselves
-    for i in range(num_clients):
-        client = socket.create_connection((SERVER_HOST, SERVER_PORT))
-        topic = generate_random_topic()
-        topics.append(topic)
-        clients.append((client, topic))
-        # Subscribe to its own topic
-        response = send_and_receive(client, {'command': 'subscribe', 'topic': topic})
-        assert response == {'success': True}
+    if server_unix_socket is not None:
+        open_connection = loop.create_unix_connection
+        address = {'path': server_unix_socket}
+        # a full accept backlog makes a non-blocking AF_UNIX connect fail with EAGAIN, which asyncio
+        # mistakes for a connect in progress; each client holds its slot until the subscribe reply,
+        # i.e. until the server accepted it, so the backlog never fills up
+        connect_slots = asyncio.Semaphore(UNIX_CONNECT_CONCURRENCY)
+    else:
+        open_connection = loop.create_connection
+        host = (await loop.getaddrinfo(SERVER_HOST, SERVER_PORT, type=socket.SOCK_STREAM))[0][4][0]
+        address = {'host': host, 'port': SERVER_PORT}
+        connect_slots = asyncio.Semaphore(num_clients)  # a TCP connect waits for the backlog, no limit needed
+    async def connect_and_subscribe(topic):
+        async with connect_slots:
+            _, client = await open_connection(ManyConnectionsClient, **address)
+            # Subscribe to its own topic
+            client.transport.write(dumps({'command': 'subscribe', 'topic': topic}) + b"\r\n")
+            await client.done
+        return client
+    # Overlap the connect and subscribe round trips across clients
+    clients = await asyncio.gather(*(connect_and_subscribe(topic) for topic in topics))
+    for client in clients:
+        assert client.received_messages == [{'success': True}]
     # Step 2: All clients select another random client and send it K messages
+    # Messages only differ in topic, sender and recipient, so encode the fixed parts once;
+    # topics are alphanumeric and need no JSON escaping
+    topic_prefixes = [b'{"command":"send","topic":"%s","msg":"test message from ' % topic.encode() for topic in topics]
+    payloads = []
     for sender_id in range(num_clients):
-        sender, sender_topic = clients[sender_id]
-        for _ in range(num_messages):
-            recipient_id = random.choice([i for i in range(num_clients) if i != sender_id])
-            recipient_topic = topics[recipient_id]
-            message = {'command': 'send', 'topic': recipient_topic, 'msg': f'test message from {sender_id} to {recipient_id}', 'delivery': 'all'}
-            # Just send the message, don't read responses, since sent messages could also be arriving
-            send(sender, message)
+        # uniform over every client except the sender, without building the candidate list
+        recipient_ids = [random.randrange(num_clients - 1) for _ in range(num_messages)]
+        recipient_ids = [r + 1 if r >= sender_id else r for r in recipient_ids]
+        sender_part = b'%d to ' % sender_id
+        payloads.append(b''.join(
+            topic_prefixes[recipient_id] + sender_part + b'%d","delivery":"all"}\r\n' % recipient_id
+            for recipient_id in recipient_ids
+        ))
+        for recipient_id in recipient_ids:
             expected_counts[sender_id] += 1    # the {'success': True}
             expected_counts[recipient_id] += 1 # the actual message
-    time.sleep(1)
+    for recipient_id, client in enumerate(clients):
+        client.expect(expected_counts[recipient_id])
+    # Send all K messages in one write, don't read responses, since sent messages could also be arriving
+    for sender_id, client in enumerate(clients):
+        client.transport.write(payloads[sender_id])
+    await asyncio.wait([client.done for client in clients], timeout=30)
     # Step 3: Clients ensure they only receive messages addressed to them
     total_received_messages = 0
     for recipient_id in range(num_clients):
-        client, topic = clients[recipient_id]
-        # received_messages = receive_many(client)
-        received_messages = receive_until(client, expected_count=expected_counts[recipient_id], timeout=1)
+        topic = topics[recipient_id]
+        received_messages = clients[recipient_id].received_messages
         assert len(received_messages) == expected_counts[recipient_id]
         assert {'success': True} in received_messages
         # Check that all received messages were addressed to this client
@@ -367,11 +550,15 @@ def _test_many_connections(server, num_clients, num_messages):
                 assert msg['topic'] == topic
                 total_received_messages += 1
     # Close all client connections
-    for client, _ in clients:
-        client.close()
+    for client in clients:
+        client.transport.close()
     # Step 4: Check that in total, all N*K messages were received
     assert total_received_messages == num_clients * num_messages
 
+def _test_many_connections(server, num_clients, num_messages):
+    # drive all the clients from one event loop, like the server does
+    asyncio.run(_async_many_connections(num_clients, num_messages))
+
 def test_many_connections_10_1(server):
     _test_many_connections(server, num_clients=10, num_messages=1)
 
@@ -408,14 +595,14 @@ def test_many_connections_10k_10(server):
 def test_cache_behavior(server):
     topic = generate_random_topic()
     # Step 1: Sender connects and sends messages to the topic
-    sender = socket.create_connection((SERVER_HOST, SERVER_PORT))
+    sender = connect()
     for i in range(CACHE_SIZE):
         message = {'command': 'send', 'topic': topic, 'msg': f'test message {i}', 'delivery': 'all'}
         response = send_and_receive(sender, message)
         assert response == {'success': True}
     sender.close()
     # Step 2: Receiver connects with cache set to False and should not receive any messages
-    receiver_no_cache = socket.create_connection((SERVER_HOST, SERVER_PORT))
+    receiver_no_cache = connect()
     response = send_and_receive(receiver_no_cache, {'command': 'subscribe', 'topic': topic, 'cache': False})
     assert response == {'success': True}
     # Ensure no more messages are received
@@ -423,7 +610,7 @@ def test_cache_behavior(server):
     assert received_messages == []
     receiver_no_cache.close()
     # Step 3: Another receiver connects with cache set to True and should receive all messages
-    receiver_with_cache = socket.create_connection((SERVER_HOST, SERVER_PORT))
+    receiver_with_cache = connect()
     received_messages = send_and_receive_many(receiver_with_cache, {'command': 'subscribe', 'topic': topic, 'cache': True})
     # Ensure all cached messages are received
     expected_messages = [
@@ -431,14 +618,15 @@ def test_cache_behavior(server):
         for i in range(CACHE_SIZE)
     ] + [{'success': True}]
     assert len(received_messages) == len(expected_messages)
+    received_set = {canonical(msg) for msg in received_messages}
     for msg in expected_messages:
-        assert msg in received_messages
+        assert canonical(msg) in received_set
     receiver_with_cache.close()
 
 def test_simple_send(server):
     topic = generate_random_topic()
-    with socket.create_connection((SERVER_HOST, SERVER_PORT)) as client1, \
-         socket.create_connection((SERVER_HOST, SERVER_PORT)) as client2:
+    with connect() as client1, \
+         connect() as client2:
         response = send_and_receive(client1, {'command': 'subscribe', 'topic': topic})
         assert response == {'success': True}
         response = send_and_receive(client2, {'command': 'send', 'topic': topic, 'msg': 'hello', 'delivery': 'all'})
@@ -446,15 +634,54 @@ def test_simple_send(server):
         response = receive(client1)
         assert response == {'command': 'send', 'topic': topic, 'msg': 'hello', 'delivery': 'all', 'index': 0}
 
+def test_unsubscribe(server):
+    topic = generate_random_topic()
+    with connect() as client1, \
+         connect() as client2:
+        response = send_and_receive(client1, {'command': 'subscribe', 'topic': topic})
+        assert response == {'success': True}
+        response = send_and_receive(client1, {'command': 'unsubscribe', 'topic': topic})
+        assert response == {'success': True}
+        response = send_and_receive(client2, {'command': 'send', 'topic': topic, 'msg': 'hello', 'delivery': 'all', 'cache': False})
+        assert response == {'success': True}
+        # Client 1 is no longer subscribed and should not receive the message
+        received_messages = receive_many(client1, timeout=0.1)
+        assert received_messages == []
+        # Subscribing again works after the topic's last subscriber left
+        response = send_and_receive(client1, {'command': 'subscribe', 'topic': topic})
+        assert response == {'success': True}
+        response = send_and_receive(client2, {'command': 'send', 'topic': topic, 'msg': 'hello again', 'delivery': 'all'})
+        assert response == {'success': True}
+        response = receive(client1)
+        assert response == {'command': 'send', 'topic': topic, 'msg': 'hello again', 'delivery': 'all', 'index': 1}
+
+def test_pipelined_commands(server):
+    topic = generate_random_topic()
+    with connect() as client1:
+        # Several commands in a single write, each must be answered in order
+        messages = [
+            {'command': 'subscribe', 'topic': topic, 'cache': False},
+            {'command': 'send', 'topic': topic, 'msg': 'hello', 'delivery': 'all'},
+            {'command': 'unsubscribe', 'topic': topic},
+        ]
+        client1.sendall(b''.join(dumps(m) + b"\r\n" for m in messages))
+        response = receive_until(client1, 4)
+        assert response == [
+            {'success': True},
+            {'command': 'send', 'topic': topic, 'msg': 'hello', 'delivery': 'all', 'index': 0},
+            {'success': True},
+            {'success': True},
+        ]
+
 def test_cache_size(server):
     topic = generate_random_topic()
-    with socket.create_connection((SERVER_HOST, SERVER_PORT)) as client1:
+    with connect() as client1:
         # Client 1 sends 5 messages to the random topic
         for i in range(5):
             message = {'command': 'send', 'topic': topic, 'msg': f'hello{i}', 'delivery': 'all'}
             response = send_and_receive(client1, message)
             assert response == {'success': True}
-    with socket.create_connection((SERVER_HOST, SERVER_PORT)) as client2:
+    with connect() as client2:
         # Client 2 subscribes to the random topic
         message = {'command': 'subscribe', 'topic': topic, 'cache': True}
         response = send_and_receive_until(client2, message, 3)
@@ -470,13 +697,13 @@ def test_cache_size(server):
 
 def test_delivery_semantics(server):
     topic = generate_random_topic()
-    with socket.create_connection((SERVER_HOST, SERVER_PORT)) as client1:
+    with connect() as client1:
         # Client 1 sends 5 messages to the random topic
         for i in range(5):
             message = {'command': 'send', 'topic': topic, 'msg': f'hello{i}', 'delivery': 'one' if i < 4 else 'all'}
             response = send_and_receive(client1, message)
             assert response == {'success': True}
-    with socket.create_connection((SERVER_HOST, SERVER_PORT)) as client2:
+    with connect() as client2:
         # Client 2 subscribes to the random topic
         message = {'command': 'subscribe', 'topic': topic, 'cache': True}
         response = send_and_receive_until(client2, message, 3)
@@ -489,7 +716,7 @@ def test_delivery_semantics(server):
             {'command': 'send', 'topic': topic, 'msg': 'hello4', 'index': 4, 'delivery': 'all'},
         ]
         assert response[-2:] == expected_messages
-    with socket.create_connection((SERVER_HOST, SERVER_PORT)) as client3:
+    with connect() as client3:
         # Client 2 subscribes to the random topic
         message = {'command': 'subscribe', 'topic': topic, 'cache': True}
         response = send_and_receive_until(client3, message, 2)
@@ -505,14 +732,14 @@ def test_delivery_semantics(server):
 def test_last_seen_behavior(server):
     topic = generate_random_topic()
     # Step 1: Sender connects and sends messages to the topic
-    sender = socket.create_connection((SERVER_HOST, SERVER_PORT))
+    sender = connect()
     for i in range(5):
         message = {'command': 'send', 'topic': topic, 'msg': f'test message {i}', 'delivery': 'all'}
         response = send_and_receive(sender, message)
         assert response == {'success': True}
     sender.close()
     # Step 2: Receiver connects with last_seen set to 2 and should only receive messages with index > 2
-    receiver = socket.create_connection((SERVER_HOST, SERVER_PORT))
+    receiver = connect()
     received_messages = send_and_receive_many(receiver, {'command': 'subscribe', 'topic': topic, 'last_seen': 2})
     # Ensure only messages with index 3 and 4 are received
     assert received_messages == [
@@ -522,7 +749,7 @@ def test_last_seen_behavior(server):
     ]
     receiver.close()
     # Step 3: Another receiver connects with last_seen set to 4 and should receive no messages
-    receiver_no_messages = socket.create_connection((SERVER_HOST, SERVER_PORT))
+    receiver_no_messages = connect()
     response = send_and_receive(receiver_no_messages, {'command': 'subscribe', 'topic': topic, 'last_seen': 4})
     assert response == {'success': True}
     # Ensure no messages are received